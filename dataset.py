@@ -1,14 +1,33 @@
 # coding = utf-8
 import gc
-import json
 import logging
 import multiprocessing
+import os
+import pickle
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 
 import numpy as np
 from gensim.models import Word2Vec, KeyedVectors
+from feature_handler.question_handler import QuestionTypeHandler
+from utils.json_io import json_loads
 from utils.read_elmo_embedding import get_elmo_vocab
 from vocab import Vocab
 
+ques_type_handler = QuestionTypeHandler()
+
+
+@lru_cache(maxsize=None)
+def _ana_question_type(question):
+	"""
+	Memoized QuestionTypeHandler.ana_type, the same question often appears in many samples
+	"""
+	question_types, type_vec = ques_type_handler.ana_type(question)
+	return tuple(question_types), tuple(type_vec.tolist())
+
 
 class MilitaryAiDataset(object):
 	"""
@@ -64,8 +83,7 @@ class MilitaryAiDataset(object):
 
 		self._convert_to_ids()
 
-		self.p_max_tokens_len = max([sample['article_tokens_len'] for sample in self.train_set + self.test_set])
-		self.q_max_tokens_len = max([sample['question_tokens_len'] for sample in self.train_set + self.test_set])
+		self._get_max_lens()
 
 		# self.p_token_max_len = max(
 		# 	[max([len(token) for token in sample['article_tokens']]) for sample in self.train_set + self.test_set])
@@ -74,7 +92,7 @@ class MilitaryAiDataset(object):
 
 		if not self.is_test:
 			#  split train & dev by article_id
-			self.total_article_ids = sorted(list(set([sample['article_id'] for sample in self.train_set])))
+			self.total_article_ids = np.unique([sample['article_id'] for sample in self.train_set]).tolist()
 			np.random.seed(self.seed)
 			np.random.shuffle(self.total_article_ids)
 			if self.cv == 0:
@@ -83,12 +101,35 @@ class MilitaryAiDataset(object):
 				
 				one_piece = int(len(self.total_article_ids) * self.dev_split)
 				self.dev_article_ids = self.total_article_ids[(self.cv - 1) * one_piece: self.cv * one_piece]
-			self.dev_set = list(
-				filter(lambda sample: sample['article_id'] in self.dev_article_ids and sample['answer_token_start'] >= 0,
-					   self.train_set))
-			self.train_set = list(filter(
-				lambda sample: sample['article_id'] not in self.dev_article_ids and sample['answer_token_start'] >= 0,
-				self.train_set))
+			self._split_train_dev()
+
+	def _get_max_lens(self):
+		"""
+		Gets the max article & question lengths over train and test in one pass
+		"""
+		p_max_tokens_len, q_max_tokens_len = 0, 0
+		for sample in chain(self.train_set, self.test_set):
+			if sample['article_tokens_len'] > p_max_tokens_len:
+				p_max_tokens_len = sample['article_tokens_len']
+			if sample['question_tokens_len'] > q_max_tokens_len:
+				q_max_tokens_len = sample['question_tokens_len']
+		self.p_max_tokens_len, self.q_max_tokens_len = p_max_tokens_len, q_max_tokens_len
+
+	def _split_train_dev(self):
+		"""
+		Splits the train set into train & dev by dev_article_ids in one pass,
+		samples without a golden span are dropped from both
+		"""
+		dev_article_ids = set(self.dev_article_ids)
+		train_set, dev_set = [], []
+		for sample in self.train_set:
+			if sample['answer_token_start'] < 0:
+				continue
+			if sample['article_id'] in dev_article_ids:
+				dev_set.append(sample)
+			else:
+				train_set.append(sample)
+		self.train_set, self.dev_set = train_set, dev_set
 
 	#
 	def _load_dataset(self):
@@ -112,13 +153,13 @@ class MilitaryAiDataset(object):
 
 
 	def _gen_hand_features(self, batch_data):
-		batch_data['wiqB'] = []
+		pad_p_len = batch_data['article_pad_len']
+		wiqB = np.zeros([len(batch_data['raw_data']), pad_p_len, 1], dtype=np.float32)
 		for sidx, sample in enumerate(batch_data['raw_data']):
-			wiqB = [[0.0]] * batch_data['article_pad_len']
-			for idx, token in enumerate(sample['article_tokens']):
-				if token in sample['question_tokens']:
-					wiqB[idx] = [1.0]
-			batch_data['wiqB'].append(wiqB)
+			question_token_set = sample['question_token_set']
+			idxs = [idx for idx, token in enumerate(sample['article_tokens'][:pad_p_len]) if token in question_token_set]
+			wiqB[sidx, idxs, 0] = 1.0
+		batch_data['wiqB'] = wiqB
 		return batch_data
 
 	def _load_from_preprocessed(self, data_path):
@@ -128,46 +169,68 @@ class MilitaryAiDataset(object):
 		:param train:  is training data
 		:return: the whole dataset
 		"""
-		from feature_handler.question_handler import QuestionTypeHandler
-		ques_type_handler = QuestionTypeHandler()
+		# the parsed samples are cached next to the json file, and rebuilt whenever the json file is newer
+		cache_path = data_path + '.pkl'
+		if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(data_path):
+			self.logger.info('Loading cached {}'.format(cache_path))
+			try:
+				with open(cache_path, 'rb') as fp:
+					return pickle.load(fp)
+			except Exception as e:
+				# a damaged cache can fail in many ways, the json file is still there to fall back to
+				self.logger.info('Broken cache {} ({!r}), loading {}'.format(cache_path, e, data_path))
 
-		with open(data_path, 'r') as fp:
-			total = json.load(fp)
+		with open(data_path, 'rb') as fp:
+			total = json_loads(fp.read())
 
 			for sample in total:
-				question_types, type_vec = ques_type_handler.ana_type(''.join(sample['question_tokens']))
-				sample['qtype'] = question_types
-				sample['qtype_vec'] = type_vec.tolist()
+				question_types, type_vec = _ana_question_type(''.join(sample['question_tokens']))
+				sample['qtype'] = list(question_types)
+				sample['qtype_vec'] = list(type_vec)
 				sample['article_tokens_len'] = len(sample['article_tokens'])
 				sample['question_tokens_len'] = len(sample['question_tokens'])
 
+		# dump to a temp file and rename it, so an interrupted dump never leaves a truncated cache behind,
+		# the cache is only an optimization, failing to write it does not fail the loading
+		tmp_path = None
+		try:
+			fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(cache_path)))
+			with os.fdopen(fd, 'wb') as fp:
+				pickle.dump(total, fp, pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp_path, cache_path)
+		except OSError as e:
+			self.logger.info('Can not write cache {} ({})'.format(cache_path, e))
+			if tmp_path is not None and os.path.exists(tmp_path):
+				os.remove(tmp_path)
+
 		return total
 
 	def _load_embeddings(self):
+		# the vectors are memory-mapped, _get_vocabs copies them into float32 matrices with the pad/unk rows
 
 		try:
 			self.logger.info("Loading pyltp flag embedding model")
-			self.pyltp_flag_wv = KeyedVectors.load(self.pyltp_flag_embed_path)
+			self.pyltp_flag_wv = KeyedVectors.load(self.pyltp_flag_embed_path, mmap='r')
 		except Exception:
 
 			self.logger.info("flag embedding model not found !")
 
 		try:
 			self.logger.info("Loading pyltp token embedding model")
-			self.pyltp_token_wv = KeyedVectors.load(self.pyltp_token_embed_path)
+			self.pyltp_token_wv = KeyedVectors.load(self.pyltp_token_embed_path, mmap='r')
 		except Exception:
 			self.logger.info("pyltp token embedding model not found !")
 
 		try:
 			self.logger.info("Loading jieba flag embedding model")
-			self.jieba_flag_wv = KeyedVectors.load(self.jieba_flag_embed_path)
+			self.jieba_flag_wv = KeyedVectors.load(self.jieba_flag_embed_path, mmap='r')
 		except Exception:
 
 			self.logger.info("jieba flag embedding model not found !")
 
 		try:
 			self.logger.info("Loading jieba token embedding model")
-			self.jieba_token_wv = KeyedVectors.load(self.jieba_token_embed_path)
+			self.jieba_token_wv = KeyedVectors.load(self.jieba_token_embed_path, mmap='r')
 		except Exception:
 			self.logger.info("jieba token embedding model not found !")
 
@@ -319,25 +382,29 @@ class MilitaryAiDataset(object):
 		pad_p_len = min(self.p_max_tokens_len, max(batch_data['article_tokens_len']))
 		pad_q_len = min(self.q_max_tokens_len, max(batch_data['question_tokens_len']))
 
-		batch_data['article_token_ids'] = [(ids + [pad_id_t] * (pad_p_len - len(ids)))[: pad_p_len]
-										   for ids in batch_data['article_token_ids']]
-		batch_data['question_token_ids'] = [(ids + [pad_id_t] * (pad_q_len - len(ids)))[: pad_q_len]
-											for ids in batch_data['question_token_ids']]
+		batch_data['article_token_ids'] = self._pad_ids(batch_data['article_token_ids'], pad_p_len, pad_id_t)
+		batch_data['question_token_ids'] = self._pad_ids(batch_data['question_token_ids'], pad_q_len, pad_id_t)
 
-		batch_data['article_flag_ids'] = [(ids + [pad_id_f] * (pad_p_len - len(ids)))[: pad_p_len]
-										  for ids in batch_data['article_flag_ids']]
-		batch_data['question_flag_ids'] = [(ids + [pad_id_f] * (pad_q_len - len(ids)))[: pad_q_len]
-										   for ids in batch_data['question_flag_ids']]
-
-		batch_data['article_elmo_ids'] = [(ids + [pad_id_e] * (pad_p_len - len(ids)))[: pad_p_len]
-										  for ids in batch_data['article_elmo_ids']]
-		batch_data['question_elmo_ids'] = [(ids + [pad_id_e] * (pad_q_len - len(ids)))[: pad_q_len]
-										   for ids in batch_data['question_elmo_ids']]
+		batch_data['article_flag_ids'] = self._pad_ids(batch_data['article_flag_ids'], pad_p_len, pad_id_f)
+		batch_data['question_flag_ids'] = self._pad_ids(batch_data['question_flag_ids'], pad_q_len, pad_id_f)
 
+		batch_data['article_elmo_ids'] = self._pad_ids(batch_data['article_elmo_ids'], pad_p_len, pad_id_e)
+		batch_data['question_elmo_ids'] = self._pad_ids(batch_data['question_elmo_ids'], pad_q_len, pad_id_e)
 
 		# print(len(batch_data))
 		return batch_data, pad_p_len, pad_q_len
 
+	@staticmethod
+	def _pad_ids(ids_list, pad_len, pad_id):
+		"""
+		Pads or truncates the id arrays of a batch into one [batch_size, pad_len] int32 array
+		"""
+		padded = np.full((len(ids_list), pad_len), pad_id, dtype=np.int32)
+		for idx, ids in enumerate(ids_list):
+			length = min(len(ids), pad_len)
+			padded[idx, :length] = ids[:length]
+		return padded
+
 	def word_iter(self, set_name=None):
 		"""
 		Iterates over all the words in the dataset
@@ -367,9 +434,13 @@ class MilitaryAiDataset(object):
 		Args:
 			vocab: the vocabulary on this dataset
 		"""
-		token2idx = self.token_vocab.token2id
-		flag2idx = self.flag_vocab.token2id
-		elmo2idx = self.elmo_vocab.token2id
+		token2id = self.token_vocab.token2id
+		flag2id = self.flag_vocab.token2id
+		elmo2id = self.elmo_vocab.token2id
+		unk_t = self.token_vocab.get_id(self.token_vocab.unk_token)
+		unk_f = self.flag_vocab.get_id(self.flag_vocab.unk_token)
+		# the elmo vocab has no <unk> entry of its own, only an oov token met during the lookup is an error
+		unk_e = elmo2id.get(self.elmo_vocab.unk_token)
 
 		for data_set in [self.train_set, self.test_set]:
 			if data_set is None:
@@ -380,22 +451,32 @@ class MilitaryAiDataset(object):
 				# sample['question_token_max_len'] = max([len(token) for token in sample['question_tokens']])
 				# sample['article_token_max_len'] = max([len(token) for token in sample['article_tokens']])
 
-				sample['question_token_ids'] = [token2idx[token] if token in token2idx.keys() else token2idx['<unk>']
-												for token in sample['question_tokens']]
-				sample['article_token_ids'] = [token2idx[token] if token in token2idx.keys() else token2idx['<unk>']
-											   for token in sample['article_tokens']]
+				sample['question_token_ids'] = self._lookup_ids(sample['question_tokens'], token2id, unk_t)
+				sample['article_token_ids'] = self._lookup_ids(sample['article_tokens'], token2id, unk_t)
+
+				sample['question_flag_ids'] = self._lookup_ids(sample['question_flags'], flag2id, unk_f)
+				sample['article_flag_ids'] = self._lookup_ids(sample['article_flags'], flag2id, unk_f)
+
+				sample['question_elmo_ids'] = self._lookup_ids(sample['question_tokens'], elmo2id, unk_e)
+				sample['article_elmo_ids'] = self._lookup_ids(sample['article_tokens'], elmo2id, unk_e)
 
-				sample['question_flag_ids'] = [flag2idx[flag] if flag in flag2idx.keys() else flag2idx['<unk>']
-											   for flag in sample['question_flags']]
-				sample['article_flag_ids'] = [flag2idx[flag] if flag in flag2idx.keys() else flag2idx['<unk>']
-											  for flag in sample['article_flags']]
+				# reused by the wiqB feature of every batch
+				sample['question_token_set'] = set(sample['question_tokens'])
 
-				sample['question_elmo_ids'] = [elmo2idx[token] if token in elmo2idx.keys() else elmo2idx['<unk>']
-											   for token in sample['question_tokens']]
-				sample['article_elmo_ids'] = [elmo2idx[token] if token in elmo2idx.keys() else elmo2idx['<unk>']
-											  for token in sample['article_tokens']]
+	@staticmethod
+	def _lookup_ids(tokens, token2id, unk_id):
+		"""
+		Look up the ids of tokens into an int32 array, unknown tokens get unk_id,
+		or raise KeyError when unk_id is None
+		"""
+		if unk_id is None:
+			ids = (token2id[token] for token in tokens)
+		else:
+			get = token2id.get
+			ids = (get(token, unk_id) for token in tokens)
+		return np.fromiter(ids, dtype=np.int32, count=len(tokens))
 
-	def gen_mini_batches(self, set_name, batch_size, shuffle=True):
+	def gen_mini_batches(self, set_name, batch_size, shuffle=True, prefetch=4):
 		"""
 		Generate data batches for a specific dataset (train/dev/test)
 		Args:
@@ -403,6 +484,8 @@ class MilitaryAiDataset(object):
 			batch_size: number of samples in one batch
 			pad_id: pad id
 			shuffle: if set to be true, the data is shuffled.
+			prefetch: number of batches prepared ahead by a background thread,
+				which runs while the session releases the GIL
 		Returns:
 			a generator for all batches
 		"""
@@ -418,9 +501,15 @@ class MilitaryAiDataset(object):
 		indices = np.arange(data_size)
 		if shuffle:
 			np.random.shuffle(indices)
-		for batch_start in np.arange(0, data_size, batch_size):
-			batch_indices = indices[batch_start: batch_start + batch_size]
-			yield self._one_mini_batch(data, batch_indices)
+		with ThreadPoolExecutor(max_workers=1) as executor:
+			pending = deque()
+			for batch_start in np.arange(0, data_size, batch_size):
+				batch_indices = indices[batch_start: batch_start + batch_size]
+				pending.append(executor.submit(self._one_mini_batch, data, batch_indices))
+				if len(pending) > prefetch:
+					yield pending.popleft().result()
+			while pending:
+				yield pending.popleft().result()
 
 	def switch(self):
 		ft = ['jieba', 'pyltp'] if self.use_jieba else ['pyltp', 'jieba']
@@ -443,8 +532,7 @@ class MilitaryAiDataset(object):
 		self._load_dataset()
 		self._convert_to_ids()
 
-		self.p_max_tokens_len = max([sample['article_tokens_len'] for sample in self.train_set + self.test_set])
-		self.q_max_tokens_len = max([sample['question_tokens_len'] for sample in self.train_set + self.test_set])
+		self._get_max_lens()
 
 		# self.p_token_max_len = max(
 		# 	[max([len(token) for token in sample['article_tokens']]) for sample in self.train_set + self.test_set])
@@ -462,12 +550,7 @@ class MilitaryAiDataset(object):
 			# 	np.random.shuffle(self.total_article_ids)
 			# 	one_piece = int(len(self.total_article_ids) * self.dev_split)
 			# 	self.dev_article_ids = self.total_article_ids[(self.cv - 1) * one_piece: self.cv * one_piece]
-			self.dev_set = list(
-				filter(lambda sample: sample['article_id'] in self.dev_article_ids and sample['answer_token_start'] >= 0,
-					   self.train_set))
-			self.train_set = list(filter(
-				lambda sample: sample['article_id'] not in self.dev_article_ids and sample['answer_token_start'] >= 0,
-				self.train_set))
+			self._split_train_dev()
 
 	def reset(self, pyltp_cfg, jieba_cfg, use_jieba=False, test=True):
 		self.__init__(pyltp_cfg, jieba_cfg, use_jieba, test)
@@ -4,10 +4,12 @@ This module prepares and runs the whole system.
 """
 import os
 import logging
-import json
 import multiprocessing
+
+import numpy as np
 from gensim.models import Word2Vec, KeyedVectors
 from preprocess import PreProcessor
+from utils.json_io import json_dump, json_loads
 from config import base_config
 from config import dataset_base_config, jieba_data_config, pyltp_data_config
 
@@ -17,6 +19,13 @@ jieba_cfg = jieba_data_config.config
 pyltp_cfg = pyltp_data_config.config
 
 
+def need_croups(cfg):
+	"""
+	the croups are only used to train the embeddings, no need to build them once both embeddings exist
+	"""
+	return not (os.path.isfile(cfg.token_embed_file) and os.path.isfile(cfg.flag_embed_file))
+
+
 def preprocess_train(cfg):
 	logger = logging.getLogger("Military AI")
 	logger.info('Preparing ' + cfg.cut_word_method + ' cut data set...')
@@ -32,13 +41,15 @@ def preprocess_train(cfg):
 		logger.info('Preprocessing train data file...')
 		p = PreProcessor(cfg)
 		raw_data_path = cfg.train_raw_file
-		croups, flag_croups, dataset = p.preprocess_dataset(raw_data_path)
-		with open(cfg.train_croups_file, 'w') as fo:
-			json.dump(croups, fo)
-		with open(cfg.train_flag_croups_file, 'w') as fo:
-			json.dump(flag_croups, fo)
-		with open(cfg.train_preprocessed_file, 'w') as fo:
-			json.dump(dataset, fo)
+		with_croups = need_croups(cfg)
+		croups, flag_croups, dataset = p.preprocess_dataset(raw_data_path, with_croups)
+		if with_croups:
+			with open(cfg.train_croups_file, 'wb') as fo:
+				json_dump(croups, fo)
+			with open(cfg.train_flag_croups_file, 'wb') as fo:
+				json_dump(flag_croups, fo)
+		with open(cfg.train_preprocessed_file, 'wb') as fo:
+			json_dump(dataset, fo)
 
 		p.release()
 
@@ -57,13 +68,15 @@ def preprocess_test(cfg):
 		logger.info('Preprocessing test data file...')
 		p = PreProcessor(cfg)
 		raw_data_path = cfg.test_raw_file
-		croups, flag_croups, dataset = p.preprocess_dataset(raw_data_path)
-		with open(cfg.test_croups_file, 'w') as fo:
-			json.dump(croups, fo)
-		with open(cfg.test_flag_croups_file, 'w') as fo:
-			json.dump(flag_croups, fo)
-		with open(cfg.test_preprocessed_file, 'w') as fo:
-			json.dump(dataset, fo)
+		with_croups = need_croups(cfg)
+		croups, flag_croups, dataset = p.preprocess_dataset(raw_data_path, with_croups)
+		if with_croups:
+			with open(cfg.test_croups_file, 'wb') as fo:
+				json_dump(croups, fo)
+			with open(cfg.test_flag_croups_file, 'wb') as fo:
+				json_dump(flag_croups, fo)
+		with open(cfg.test_preprocessed_file, 'wb') as fo:
+			json_dump(dataset, fo)
 
 		p.release()
 
@@ -71,11 +84,11 @@ def preprocess_test(cfg):
 def prepare_vocab(cfg):
 	logger = logging.getLogger("Military AI")
 	if not os.path.isfile(cfg.token_embed_file):
-		with open(cfg.train_croups_file, 'r') as fp:
-			croups = json.load(fp)
+		with open(cfg.train_croups_file, 'rb') as fp:
+			croups = json_loads(fp.read())
 		if cfg.use_test_vocab:
-			with open(cfg.test_croups_file, 'r') as fp:
-				croups += json.load(fp)
+			with open(cfg.test_croups_file, 'rb') as fp:
+				croups += json_loads(fp.read())
 
 		logger.info("Training token embedding model")
 		token_wv = Word2Vec(croups,
@@ -83,15 +96,17 @@ def prepare_vocab(cfg):
 							window=5, compute_loss=True,
 							min_count=cfg.token_min_cnt, iter=75,
 							workers=multiprocessing.cpu_count()).wv
+		# stored as float16 to halve the cache, it is upcast to float32 when building the vocab
+		token_wv.vectors = token_wv.vectors.astype(np.float16)
 		token_wv.save(cfg.token_embed_file)
 		del token_wv, croups
 
 	if not os.path.isfile(cfg.flag_embed_file):
-		with open(cfg.train_flag_croups_file, 'r') as fp:
-			flag_croups = json.load(fp)
+		with open(cfg.train_flag_croups_file, 'rb') as fp:
+			flag_croups = json_loads(fp.read())
 		if cfg.use_test_vocab:
-			with open(cfg.test_flag_croups_file, 'r') as fp:
-				flag_croups += json.load(fp)
+			with open(cfg.test_flag_croups_file, 'rb') as fp:
+				flag_croups += json_loads(fp.read())
 
 		logger.info("Training flag embedding model")
 		flag_wv = Word2Vec(flag_croups,
@@ -99,6 +114,7 @@ def prepare_vocab(cfg):
 							window=5, compute_loss=True,
 							min_count=1, iter=75,
 							workers=multiprocessing.cpu_count()).wv
+		flag_wv.vectors = flag_wv.vectors.astype(np.float16)
 		flag_wv.save(cfg.flag_embed_file)
 
 	logger.info("Done!")
@@ -13,11 +13,31 @@ import numpy as np
 import pandas as pd
 
 from utils.rouge import RougeL
+from utils.rouge_numba import batch_rouge_l, set_num_threads
+from utils.span_gate import article_char_ids, gate_spans
 
 
 ltp_seg = Segmentor()
 ltp_pos = Postagger()
 
+# clean_text substitutions, the single char ones are done by str.translate in one scan
+_SPACE_TABLE = str.maketrans({'\u3000': ' ', '\t': ' '})
+_RE_MULTI_SPACE = re.compile(r'\s{2,}')
+_CLEAN_TABLE = str.maketrans(dict({'“': None, '”': None, '\r': ' ', '\n': ' ', '．': '.'},
+								  **{chr(ord('０') + i): str(i) for i in range(10)}))
+
+# weights spreading a top sentence's score over s_rank[pos - 2: pos + 5] in _sample_article
+_BLOCK_KERNEL = np.array([0.5, 0.9, 1.0, 1.0, 0.9, 0.5, 0.4])
+# _BLOCK_KERNEL = np.array([0.25, 0.5, 1.0, 0.8, 0.64, 0.512, 0.4096])
+
+# every worker gets several small pieces instead of one big one, so a few long articles do not stall the pool
+SPLITS_PER_CPU = 4
+
+
+def _init_pool_worker():
+	# the pool already uses every core, keep the parallel numba kernels single threaded in the workers
+	set_num_threads(1)
+
 
 class PreProcessor():
 
@@ -30,6 +50,8 @@ class PreProcessor():
 			if os.path.isfile(cfg.jieba_big_dict_path):
 				jieba.set_dictionary(cfg.jieba_big_dict_path)
 			jieba.setLogLevel(logging.INFO)
+			# load the dictionary once here, forked pool workers share it instead of loading their own
+			jieba.initialize()
 		elif cfg.cut_word_method == 'pyltp':
 			ltp_seg.load(cfg.pyltp_cws_model_path)
 			ltp_pos.load(cfg.pyltp_pos_model_path)
@@ -75,27 +97,16 @@ class PreProcessor():
 		"""
 
 		def clean(row):
-			row = re.sub('[\u3000\t]', ' ', row)
-			row = re.sub('\s{2,}', '', row)
-			row = re.sub('[“”]', '', row)
-			row = re.sub('[\r\n]', ' ', row)
+			row = row.translate(_SPACE_TABLE)
+			row = _RE_MULTI_SPACE.sub('', row)
 
 			# p_l = re.compile(r'\s+([\u4e00-\u9fa5, ]{1})')
 			# p_r = re.compile(r'([\u4e00-\u9fa5, ]{1})\s+')
 			# row = p_l.sub('\1', row)
 			# row = p_r.sub('\1', row)
 
-			row = re.sub(r'０', '0', row)
-			row = re.sub(r'１', '1', row)
-			row = re.sub(r'２', '2', row)
-			row = re.sub(r'３', '3', row)
-			row = re.sub(r'４', '4', row)
-			row = re.sub(r'５', '5', row)
-			row = re.sub(r'６', '6', row)
-			row = re.sub(r'７', '7', row)
-			row = re.sub(r'８', '8', row)
-			row = re.sub(r'９', '9', row)
-			row = re.sub(r'．', '.', row)
+			# drop quotes, \r\n to ' ', full-width digits and dots to half written
+			row = row.translate(_CLEAN_TABLE)
 
 			if len(row) > 0 and row[-1] == '。':
 				row = row[:-1].strip()
@@ -136,10 +147,13 @@ class PreProcessor():
 			:return:
 			"""
 
-			cut_res = pseg.lcut(row, HMM=False)
+			tokens, flags = [], []
+			for res in pseg.cut(row, HMM=False):
+				tokens.append(res.word)
+				flags.append(res.flag)
 			new_row = pd.Series()
-			new_row['tokens'] = [res.word for res in cut_res]
-			new_row['flags'] = [res.flag for res in cut_res]
+			new_row['tokens'] = tokens
+			new_row['flags'] = flags
 			return new_row
 
 		sentence_cut = df[col].apply(_cut)
@@ -174,22 +188,45 @@ class PreProcessor():
 		return sentence_cut
 
 
-	def parallel_cut(self,df, col):
+	@staticmethod
+	def _parallel_apply(func, df: pd.DataFrame):
+		"""
+		apply func on pieces of df in a process pool
+		:param func: function taking a piece of df
+		:param df:
+		:return: the merged results, in the order of df
+		"""
 		n_cpu = mp.cpu_count()
-		with mp.Pool(processes=n_cpu) as p:
-			split_dfs = np.array_split(df, n_cpu)
-
-			if self.cfg.cut_word_method == 'jieba':
-				pool_results = p.map(partial(self._apply_cut_jieba, col=col), split_dfs)
-			elif self.cfg.cut_word_method == 'pyltp':
-				pool_results = p.map(partial(self._apply_cut_pyltp, col=col), split_dfs)
-			else:
-				pool_results = p.map(partial(self._apply_cut_jieba, col=col), split_dfs)
+		n_split = max(min(len(df), n_cpu * SPLITS_PER_CPU), 1)
+		with mp.Pool(processes=n_cpu, initializer=_init_pool_worker) as p:
+			split_dfs = np.array_split(df, n_split)
+			pool_results = list(p.imap(func, split_dfs))
 
 		# merging parts processed by different processes
 		res = pd.concat(pool_results, axis=0)
 		return res
 
+	def parallel_cut(self,df, col):
+		if self.cfg.cut_word_method == 'pyltp':
+			return self._parallel_apply(partial(self._apply_cut_pyltp, col=col), df)
+		return self._parallel_apply(partial(self._apply_cut_jieba, col=col), df)
+
+	def parallel_cut_texts(self, text_cols):
+		"""
+		cut several text columns in one pool pass, every distinct text is only cut once
+		:param text_cols: list of pd.Series of texts
+		:return: list of (tokens, flags) for each column
+		"""
+		texts = pd.unique(pd.concat(text_cols, ignore_index=True))
+		cut = self.parallel_cut(pd.DataFrame({'text': texts}), 'text')
+		text2cut = dict(zip(texts, zip(cut['tokens'], cut['flags'])))
+
+		res = []
+		for col in text_cols:
+			col_cut = [text2cut[text] for text in col]
+			res.append(([tokens for tokens, _ in col_cut], [flags for _, flags in col_cut]))
+		return res
+
 	@staticmethod
 	def clean_token(article_df: pd.DataFrame, qa_df: pd.DataFrame):
 		"""
@@ -241,67 +278,59 @@ class PreProcessor():
 
 			if len(article_tokens) <= max_token_len:
 				return row
-			sentences, sentences_f = [], []
-			cur_s, cur_s_f = [], []
+			# sentences are kept as [start, end) token spans, each joined into a string once
+			sentences, sentence_strs = [], []
+			s_start = 0
 			question = ''.join(question_tokens)
 
 			cand, cand_f = [], []
-			rl = RougeL()
-			for idx, (token, flag) in enumerate(zip(article_tokens, article_flags)):
-				cur_s.append(token)
-				cur_s_f.append(flag)
-
+			for idx, token in enumerate(article_tokens):
 				if token in '。' or idx == len(article_tokens) - 1:
-					if len(cur_s) >= 2:
-						sentences.append(cur_s)
-						sentences_f.append(cur_s_f)
-						cur_s_str = ''.join(cur_s)
-						rl.add_inst(cur_s_str, question)
-						if rl.p_scores[-1] == 1.0:
-							rl.r_scores[-1] = 1.0
-					cur_s, cur_s_f = [], []
-					continue
+					if idx + 1 - s_start >= 2:
+						sentences.append((s_start, idx + 1))
+						sentence_strs.append(''.join(article_tokens[s_start: idx + 1]))
+					s_start = idx + 1
 
 			if '。' not in ''.join(article_tokens):
-				row[article_tokens_col] = sentences[0]
-				row[article_flags_col] = sentences_f[0]
+				s_start, s_end = sentences[0]
+				row[article_tokens_col] = article_tokens[s_start: s_end]
+				row[article_flags_col] = article_flags[s_start: s_end]
 				return row
 
-			scores = rl.r_scores
+			_, p_scores, scores = batch_rouge_l(sentence_strs, question)
+			scores[p_scores == 1.0] = 1.0
+
 			s_rank = np.zeros(len(sentences))
-			arg_sorted = list(reversed(np.argsort(scores)))
+			# the blocks of the 10 best sentences are merged by max, so only the set of them matters, not the order
+			n_top = min(10, len(scores))
+			top_pos = np.argpartition(-scores, n_top - 1)[:n_top] if n_top > 0 else []
 
-			for i in range(10):
-				if i >= len(sentences):
-					break
-				pos = arg_sorted[i]
+			for pos in top_pos:
 				score = scores[pos]
 				if pos in [0, 1, len(sentences) - 1, len(sentences) - 2] or score == 0:
 					continue
-				block_scores = np.array([0.5 * score, 0.9 * score, score, score, 0.9 * score, 0.5 * score, 0.4 * score])
-				# block_scores = np.array([0.25*score, 0.5*score, score, 0.8*score, 0.64*score, 0.512*score, 0.4096*score])
 				block = s_rank[pos - 2: pos + 5]
-				block_scores = block_scores[:len(block)]
-				block_scores = np.max(np.stack([block_scores, block]), axis=0)
-				s_rank[pos - 2: pos + 5] = block_scores
+				np.maximum(block, score * _BLOCK_KERNEL[:len(block)], out=block)
 
 			rank = list(reversed(np.argsort(s_rank)))
 			flag = [0 for i in range(len(sentences))]
 			flag[0], flag[1], flag[-1], flag[-2] = 1, 1, 1, 1
-			cur_len = len(sentences[0]) + len(sentences[1]) + len(sentences[-1]) + len(sentences[-2])
+			sentence_lens = [s_end - s_start for s_start, s_end in sentences]
+			cur_len = sentence_lens[0] + sentence_lens[1] + sentence_lens[-1] + sentence_lens[-2]
 
 			for pos in rank:
 				if cur_len < max_token_len:
 					if s_rank[pos] > 0:
 						flag[pos] = 1
-						cur_len += len(sentences[pos])
+						cur_len += sentence_lens[pos]
 				else:
 					break
 
 			for i in range(len(flag)):
 				if flag[i] != 0:
-					cand.extend(sentences[i])
-					cand_f.extend(sentences_f[i])
+					s_start, s_end = sentences[i]
+					cand.extend(article_tokens[s_start: s_end])
+					cand_f.extend(article_flags[s_start: s_end])
 
 			row[article_tokens_col] = cand[:max_token_len]
 			row[article_flags_col] = cand_f[:max_token_len]
@@ -316,17 +345,11 @@ class PreProcessor():
 
 	def parallel_sample_article(self, article_df: pd.DataFrame, qa_df: pd.DataFrame, max_token_len=400):
 		sample_df = pd.merge(article_df, qa_df, how='inner', on=['article_id'])
-		n_cpu = mp.cpu_count()
-		with mp.Pool(processes=n_cpu) as p:
-			split_dfs = np.array_split(sample_df, n_cpu)
-			pool_results = p.map(partial(self._apply_sample_article,
-										 article_tokens_col='article_tokens',
-										 article_flags_col='article_flags',
-										 question_tokens_col='question_tokens',
-										 max_token_len=max_token_len), split_dfs)
-
-		# merging parts processed by different processes
-		res = pd.concat(pool_results, axis=0)
+		res = self._parallel_apply(partial(self._apply_sample_article,
+										   article_tokens_col='article_tokens',
+										   article_flags_col='article_flags',
+										   question_tokens_col='question_tokens',
+										   max_token_len=max_token_len), sample_df)
 
 		return res
 
@@ -348,28 +371,31 @@ class PreProcessor():
 			questrin_str = ''.join(question_tokens).strip()
 			len_p = len(article_tokens)
 			len_a = len(answer_tokens)
-			s2 = set(ground_ans)
 			star_spans = []
 			end_spans = []
 			rl_q_idx = []
-			for i in range(len_p - len_a + 1):
-				for t_len in range(len_a - 2, len_a + 3):
-					if t_len <= 0 or i + t_len > len_p:
-						continue
-					cand_ans = ''.join(article_tokens[i:i + t_len]).strip()
-					s1 = set(cand_ans)
-					mlen = max(len(s1), len(s2))
-					iou = len(s1.intersection(s2)) / mlen if mlen != 0 else 0.0
-					if iou >= 0.25:
-						rl.add_inst(cand_ans, ground_ans)
-						if rl.inst_scores[-1] == 1.0:
-							s = max(i - 7, 0)
-							cand_ctx = ''.join(article_tokens[s:i + t_len + 3]).strip()
-							rl_q.add_inst(cand_ctx, questrin_str)
-							rl_q_idx.append(len(star_spans))
-
-						star_spans.append(i)
-						end_spans.append(i + t_len - 1)
+
+			# compact char ids over article and answer chars, so the gate runs on int arrays
+			article_str = ''.join(article_tokens)
+			char_ids, s2_mask = article_char_ids(article_str, ground_ans)
+			token_char_starts = np.zeros(len_p + 1, dtype=np.int32)
+			np.cumsum([len(token) for token in article_tokens], out=token_char_starts[1:])
+
+			# candidates are sliced out of the flat article instead of re-joining their tokens
+			char_starts = token_char_starts.tolist()
+			# the gate counts the chars of the joined tokens, it matches the old set(cand_ans.strip()) IoU
+			# only because clean_token has already stripped every token
+			for i, t_len in gate_spans(char_ids, token_char_starts, len_a, s2_mask, 0.25).tolist():
+				cand_ans = article_str[char_starts[i]:char_starts[i + t_len]].strip()
+				rl.add_inst(cand_ans, ground_ans)
+				if rl.inst_scores[-1] == 1.0:
+					s = max(i - 7, 0)
+					cand_ctx = article_str[char_starts[s]:char_starts[min(i + t_len + 3, len_p)]].strip()
+					rl_q.add_inst(cand_ctx, questrin_str)
+					rl_q_idx.append(len(star_spans))
+
+				star_spans.append(i)
+				end_spans.append(i + t_len - 1)
 			if len(star_spans) == 0:
 				return row
 			else:
@@ -446,42 +472,30 @@ class PreProcessor():
 
 
 	def parallel_find_gold_span(self, sample_df: pd.DataFrame):
-		n_cpu = mp.cpu_count()
-		with mp.Pool(processes=n_cpu) as p:
-			split_dfs = np.array_split(sample_df, n_cpu)
-			pool_results = p.map(partial(self._apply_find_gold_span,
-										 article_tokens_col='article_tokens',
-										 question_tokens_col='question_tokens',
-										 answer_tokens_col='answer_tokens'),
-								 split_dfs)
-
-		# merging parts processed by different processes
-		res = pd.concat(pool_results, axis=0)
+		res = self._parallel_apply(partial(self._apply_find_gold_span,
+										   article_tokens_col='article_tokens',
+										   question_tokens_col='question_tokens',
+										   answer_tokens_col='answer_tokens'), sample_df)
 
 		return res
 
 
-	def preprocess_dataset(self, raw_path):
+	def preprocess_dataset(self, raw_path, with_croups=True):
 
 
 
 		adf, qadf = self.trans_to_df(raw_path)
 		adf, qadf = self.clean_text(adf, qadf)
 
-		article_cut = self.parallel_cut(adf, 'article')
+		cut_cols = [(adf, 'article'), (qadf, 'question')]
+		if 'answer' in qadf.columns:
+			cut_cols.append((qadf, 'answer'))
+		cut_res = self.parallel_cut_texts([df[col] for df, col in cut_cols])
+		for (df, col), (tokens, flags) in zip(cut_cols, cut_res):
+			df[col + '_tokens'] = tokens
+			df[col + '_flags'] = flags
 		adf.drop(['article'], axis=1, inplace=True)
-		adf['article_tokens'] = article_cut['tokens']
-		adf['article_flags'] = article_cut['flags']
-
-		question_cut = self.parallel_cut(qadf, 'question')
 		qadf.drop(['question'], axis=1, inplace=True)
-		qadf['question_tokens'] = question_cut['tokens']
-		qadf['question_flags'] = question_cut['flags']
-
-		if 'answer' in qadf.columns:
-			ans_cut = self.parallel_cut(qadf, 'answer')
-			qadf['answer_tokens'] = ans_cut['tokens']
-			qadf['answer_flags'] = ans_cut['flags']
 
 		adf, qadf = self.clean_token(adf, qadf)
 		if 'answer' in qadf.columns:
@@ -491,11 +505,13 @@ class PreProcessor():
 			sample_df = self.parallel_sample_article(adf, qadf, self.cfg.article_sample_len_test)
 
 
-		croups = list(adf['article_tokens']) + list(qadf['question_tokens'])
-		flag_croups = list(adf['article_flags']) + list(qadf['question_flags'])
-		if 'answer' in qadf.columns:
-			croups += list(qadf['answer_tokens'])
-			flag_croups += list(qadf['answer_flags'])
+		croups, flag_croups = None, None
+		if with_croups:
+			croups = list(adf['article_tokens']) + list(qadf['question_tokens'])
+			flag_croups = list(adf['article_flags']) + list(qadf['question_flags'])
+			if 'answer' in qadf.columns:
+				croups += list(qadf['answer_tokens'])
+				flag_croups += list(qadf['answer_flags'])
 		sample_df = sample_df.to_dict(orient='records')
 
 		return croups, flag_croups, sample_df
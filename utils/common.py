@@ -2,6 +2,20 @@
 from collections import defaultdict
 import re
 
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    # without numba the kernels decorated below run as plain python
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+    def set_num_threads(n):
+        pass
+
 
 def get_match_size(cand_ngram: list, ref_ngram: list) -> (int, int):
     ref_set = defaultdict(int)
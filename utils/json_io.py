@@ -0,0 +1,35 @@
+# coding = utf-8
+"""
+orjson backed json helpers for the preprocessed files, falling back to the stdlib json
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data: bytes):
+    """
+    parse json bytes, orjson rejects escaped lone surrogates like "\\ud83d" that json.loads accepts
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def json_dump(obj, fo):
+    """
+    write obj as utf-8 json to the binary file fo, orjson rejects lone surrogates that json.dumps escapes
+    """
+    if orjson is not None:
+        try:
+            fo.write(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY))
+            return
+        except TypeError:
+            pass
+    fo.write(json.dumps(obj).encode('utf-8'))
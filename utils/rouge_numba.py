@@ -0,0 +1,63 @@
+# coding = utf-8
+import numpy as np
+
+from .common import njit, prange, set_num_threads
+
+
+@njit(parallel=True, cache=True)
+def batch_lcs(cand_ids, cand_lens, ref_ids):
+    """
+    Computes the length of the longest common subsequence between every candidate and the reference,
+    one rolling dp row per candidate, candidates are independent so they run in parallel.
+    Args:
+      cand_ids: int32 [n_cand, max_len] char ids of the candidates, padded
+      cand_lens: int32 [n_cand] lengths of the candidates
+      ref_ids: int32 [ref_len] char ids of the reference
+    Returns:
+      int32 [n_cand] lcs lengths
+    """
+    n_cand = cand_ids.shape[0]
+    m = ref_ids.shape[0]
+    lcs = np.zeros(n_cand, dtype=np.int32)
+    for k in prange(n_cand):
+        dp = np.zeros(m + 1, dtype=np.int32)
+        for i in range(cand_lens[k]):
+            prev = 0
+            for j in range(1, m + 1):
+                cur = dp[j]
+                if cand_ids[k, i] == ref_ids[j - 1]:
+                    dp[j] = prev + 1
+                elif dp[j - 1] > cur:
+                    dp[j] = dp[j - 1]
+                prev = cur
+        lcs[k] = dp[m]
+    return lcs
+
+
+def _code_points(string: str):
+    # lone surrogates from json escapes are kept as chars, as RougeL does on the str
+    return np.frombuffer(string.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32).astype(np.int32)
+
+
+def batch_rouge_l(cands: list, ref: str, gamma=1.2):
+    """计算多个预测答案与同一参考答案的RougeL分数, 与RougeL.add_inst的分数一致
+
+    Arguments:
+        cands {list} -- 预测答案
+        ref {str} -- 参考答案
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray) -- 每个预测答案的分数, precision, recall
+    """
+    cand_lens = np.array([len(cand) for cand in cands], dtype=np.int32)
+    cand_ids = np.zeros((len(cands), cand_lens.max(initial=0)), dtype=np.int32)
+    for k, cand in enumerate(cands):
+        cand_ids[k, :cand_lens[k]] = _code_points(cand)
+
+    lcs = batch_lcs(cand_ids, cand_lens, _code_points(ref)).astype(np.float64)
+    prec = np.divide(lcs, cand_lens, out=np.zeros(len(cands)), where=cand_lens > 0)
+    rec = lcs / len(ref) if len(ref) > 0 else np.zeros(len(cands))
+    valid = (prec != 0) & (rec != 0)
+    scores = np.zeros(len(cands))
+    scores[valid] = ((1 + gamma ** 2) * prec[valid] * rec[valid]) / (rec[valid] + gamma ** 2 * prec[valid])
+    return scores, prec, rec
@@ -0,0 +1,97 @@
+# coding = utf-8
+import numpy as np
+
+from .common import njit
+
+
+@njit(cache=True, boundscheck=False)
+def _update_char_cnt(cnt, char_ids, s2_mask, start, end, delta):
+    """
+    add (delta=1) or remove (delta=-1) the chars in [start, end) to the window counts
+    :return: change of the distinct chars, change of the distinct chars shared with the answer
+    """
+    d_chars, d_inter = 0, 0
+    for pos in range(start, end):
+        c = char_ids[pos]
+        before = cnt[c]
+        cnt[c] = before + delta
+        if before == 0 or cnt[c] == 0:
+            d_chars += delta
+            if s2_mask[c]:
+                d_inter += delta
+    return d_chars, d_inter
+
+
+@njit(cache=True, boundscheck=False, fastmath=True)
+def gate_spans(char_ids, token_char_starts, len_a, s2_mask, min_iou):
+    """
+    slide over the article and keep the candidate spans whose char set IoU with the answer >= min_iou
+    :param char_ids: char ids of the flattened article, its tokens must already be stripped
+    :param token_char_starts: char offset of every token, followed by the total char count
+    :param len_a: answer length in tokens, candidates have len_a - 2 ~ len_a + 2 tokens
+    :param s2_mask: 1 for the char ids in the answer
+    :param min_iou:
+    :return: int32 array of (start token, token length) in scan order
+    """
+    len_p = token_char_starts.shape[0] - 1
+    t_min = max(len_a - 2, 1)
+    t_max = len_a + 2
+    n_s2 = 0
+    for m in s2_mask:
+        n_s2 += m
+    cnt = np.zeros(s2_mask.shape[0], dtype=np.int32)
+    spans = np.empty((max(len_p - len_a + 1, 0) * (t_max - t_min + 1), 2), dtype=np.int32)
+    n_spans, n_chars, n_inter, win_end = 0, 0, 0, 0
+    for i in range(len_p - len_a + 1):
+        if i > 0:
+            d_chars, d_inter = _update_char_cnt(cnt, char_ids, s2_mask,
+                                                token_char_starts[i - 1], token_char_starts[i], -1)
+            n_chars += d_chars
+            n_inter += d_inter
+        # the window always covers the shortest candidate [i, i + t_min)
+        base_end = min(i + t_min, len_p)
+        d_chars, d_inter = _update_char_cnt(cnt, char_ids, s2_mask,
+                                            token_char_starts[win_end], token_char_starts[base_end], 1)
+        n_chars += d_chars
+        n_inter += d_inter
+        win_end = base_end
+        t_end = base_end
+        # n_inter <= chars in the window, so windows shorter than min_iou * n_s2 chars can never pass,
+        # if even the longest candidate from i is that short skip extending the window at all
+        if token_char_starts[min(i + t_max, len_p)] - token_char_starts[i] < min_iou * n_s2:
+            continue
+        for t_len in range(t_min, t_max + 1):
+            if i + t_len > len_p:
+                break
+            if i + t_len > t_end:
+                d_chars, d_inter = _update_char_cnt(cnt, char_ids, s2_mask,
+                                                    token_char_starts[t_end], token_char_starts[i + t_len], 1)
+                n_chars += d_chars
+                n_inter += d_inter
+                t_end = i + t_len
+            mlen = max(n_chars, n_s2)
+            if mlen > 0 and n_inter >= min_iou * mlen:
+                spans[n_spans, 0] = i
+                spans[n_spans, 1] = t_len
+                n_spans += 1
+        # shrink back to the shortest candidate before sliding on
+        d_chars, d_inter = _update_char_cnt(cnt, char_ids, s2_mask,
+                                            token_char_starts[base_end], token_char_starts[t_end], -1)
+        n_chars += d_chars
+        n_inter += d_inter
+    return spans[:n_spans]
+
+
+def article_char_ids(article_str: str, answer_str: str):
+    """
+    map the chars of the article and the answer to compact ids, from the utf-32 code points in one vectorized pass,
+    lone surrogates (decoded from json escapes like \\ud83d) are kept as their own chars
+    :return: int32 char ids of the article, uint8 mask of the ids that occur in the answer
+    """
+    article_cps = np.frombuffer(article_str.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    answer_cps = np.frombuffer(answer_str.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    uniq_cps, ids = np.unique(np.concatenate([article_cps, answer_cps]), return_inverse=True)
+    ids = ids.reshape(-1).astype(np.int32)
+    s2_mask = np.zeros(len(uniq_cps), dtype=np.uint8)
+    s2_mask[ids[len(article_cps):]] = 1
+    return ids[:len(article_cps)], s2_mask
@@ -0,0 +1,24 @@
+# coding = utf-8
+import io
+
+from .json_io import json_dump, json_loads
+
+
+def test_json_round_trip():
+    obj = [{'article_tokens': ['中华', '人民'], 'answer_token_start': 1}]
+    fo = io.BytesIO()
+    json_dump(obj, fo)
+    assert json_loads(fo.getvalue()) == obj
+
+
+def test_json_surrogate():
+    assert json_loads(b'["\\ud83d"]') == ['\ud83d']
+    fo = io.BytesIO()
+    json_dump(['中华\ud83d'], fo)
+    print('dumped: {}'.format(fo.getvalue()))
+    assert json_loads(fo.getvalue()) == ['中华\ud83d']
+
+
+if __name__ == '__main__':
+    test_json_round_trip()
+    test_json_surrogate()
@@ -0,0 +1,49 @@
+# coding = utf-8
+import numpy as np
+
+from .rouge import RougeL
+from .rouge_numba import batch_lcs, batch_rouge_l, _code_points
+
+
+def test_batch_rouge_l():
+    cands = ['中华人民共和国中的人', '中华人民', '']
+    ref = '中国人民共和国的'
+    rouge = RougeL()
+    scores, prec, rec = batch_rouge_l(cands, ref)
+    for cand, score, p, r in zip(cands, scores, prec, rec):
+        rouge.add_inst(cand, ref)
+        assert score == rouge.inst_scores[-1]
+        assert p == rouge.p_scores[-1]
+        assert r == rouge.r_scores[-1]
+    print('scores: {}'.format(scores))
+
+
+def test_batch_rouge_l_surrogate():
+    cands = ['中华\ud83d人民', '\ud83d']
+    ref = '中国\ud83d人民'
+    rouge = RougeL()
+    scores, prec, rec = batch_rouge_l(cands, ref)
+    for cand, score in zip(cands, scores):
+        rouge.add_inst(cand, ref)
+        assert score == rouge.inst_scores[-1]
+    print('scores: {}'.format(scores))
+
+
+def test_batch_rouge_l_empty_ref():
+    scores, prec, rec = batch_rouge_l(['中华人民'], '')
+    assert scores[0] == 0 and rec[0] == 0
+    print('scores: {}'.format(scores))
+
+
+def test_lcs_kernel():
+    cand_ids = _code_points('中华人民').reshape(1, -1)
+    lcs = batch_lcs(cand_ids, np.array([cand_ids.shape[1]], dtype=np.int32), _code_points('中国人民共和国的'))
+    print('lcs: {}'.format(lcs))
+    assert lcs[0] == 3
+
+
+if __name__ == '__main__':
+    test_batch_rouge_l()
+    test_batch_rouge_l_surrogate()
+    test_batch_rouge_l_empty_ref()
+    test_lcs_kernel()
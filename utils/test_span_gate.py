@@ -0,0 +1,74 @@
+# coding = utf-8
+import random
+
+import numpy as np
+
+from .span_gate import article_char_ids, gate_spans
+
+
+def _set_iou_spans(article_tokens, answer_tokens, min_iou):
+    # the set IoU loop find_golden_span used before the kernel
+    ground_ans = ''.join(answer_tokens).strip()
+    len_p = len(article_tokens)
+    len_a = len(answer_tokens)
+    s2 = set(ground_ans)
+    spans = []
+    for i in range(len_p - len_a + 1):
+        for t_len in range(len_a - 2, len_a + 3):
+            if t_len <= 0 or i + t_len > len_p:
+                continue
+            s1 = set(''.join(article_tokens[i:i + t_len]).strip())
+            mlen = max(len(s1), len(s2))
+            iou = len(s1.intersection(s2)) / mlen if mlen != 0 else 0.0
+            if iou >= min_iou:
+                spans.append((i, t_len))
+    return spans
+
+
+def _kernel_spans(article_tokens, answer_tokens, min_iou):
+    char_ids, s2_mask = article_char_ids(''.join(article_tokens), ''.join(answer_tokens).strip())
+    token_char_starts = np.zeros(len(article_tokens) + 1, dtype=np.int32)
+    np.cumsum([len(token) for token in article_tokens], out=token_char_starts[1:])
+    spans = gate_spans(char_ids, token_char_starts, len(answer_tokens), s2_mask, min_iou)
+    return [tuple(span) for span in spans.tolist()]
+
+
+def _random_tokens(rng, n):
+    return [''.join(rng.choice('中华人民共和国的军队') for _ in range(rng.randint(1, 3))) for _ in range(n)]
+
+
+def test_gate_spans():
+    rng = random.Random(0)
+    for _ in range(300):
+        article_tokens = _random_tokens(rng, rng.randint(0, 30))
+        answer_tokens = _random_tokens(rng, rng.randint(0, 6))
+        assert _kernel_spans(article_tokens, answer_tokens, 0.25) == \
+            _set_iou_spans(article_tokens, answer_tokens, 0.25)
+
+
+def test_gate_spans_empty_answer():
+    article_tokens = ['中华', '人民', '共和国']
+    assert _kernel_spans(article_tokens, [], 0.25) == _set_iou_spans(article_tokens, [], 0.25)
+
+
+def test_gate_spans_short_article():
+    article_tokens = ['中华', '人民']
+    answer_tokens = ['中华', '人民', '共和国', '的']
+    spans = _kernel_spans(article_tokens, answer_tokens, 0.25)
+    print('spans: {}'.format(spans))
+    assert spans == _set_iou_spans(article_tokens, answer_tokens, 0.25) == []
+
+
+def test_gate_spans_surrogate():
+    article_tokens = ['中华', '\ud83d', '人民', '共和国']
+    answer_tokens = ['\ud83d', '人民']
+    spans = _kernel_spans(article_tokens, answer_tokens, 0.25)
+    print('spans: {}'.format(spans))
+    assert spans == _set_iou_spans(article_tokens, answer_tokens, 0.25)
+
+
+if __name__ == '__main__':
+    test_gate_spans()
+    test_gate_spans_empty_answer()
+    test_gate_spans_short_article()
+    test_gate_spans_surrogate()